@@ -2,6 +2,7 @@ from firedrake import *
 import pytest
 import numpy as np
 from mpi4py import MPI
+from contextlib import contextmanager
 
 
 # Utility Functions
@@ -11,29 +12,77 @@ def cell_midpoints(m):
 
     :param m: The mesh to generate cell midpoints for.
 
-    :returns: A tuple of numpy arrays `(midpoints, local_midpoints)` where
+    :returns: A tuple `(midpoints, local_midpoints, f)` where
     `midpoints` are the midpoints for the entire mesh even if the mesh is
-    distributed and `local_midpoints` are the midpoints of only the
-    rank-local non-ghost cells."""
+    distributed, `local_midpoints` are the midpoints of only the
+    rank-local non-ghost cells and `f` is the DG0 vector
+    :class:`Function` of midpoints they were taken from. The result is
+    cached on `m` so repeated calls for the same mesh do no further
+    work."""
     if isinstance(m.topology, mesh.ExtrudedMeshTopology):
         raise NotImplementedError("Extruded meshes are not supported")
+    try:
+        return m.__dict__["_cell_midpoints"]
+    except KeyError:
+        pass
     m.init()
     V = VectorFunctionSpace(m, "DG", 0)
     f = Function(V).interpolate(SpatialCoordinate(m))
     # since mesh may be distributed, the number of cells on the MPI rank
     # may not be the same on all ranks (note we exclude ghost cells
-    # hence using num_cells_local = m.cell_set.size). Below local means
-    # MPI rank local.
-    num_cells_local = m.cell_set.size
-    num_cells = MPI.COMM_WORLD.allreduce(num_cells_local, op=MPI.SUM)
+    # hence using f.dat.data_ro rather than f.dat.data_ro_with_halos).
+    # Below local means MPI rank local.
+    gdim = m.geometric_dimension()
     local_midpoints = f.dat.data_ro
-    local_midpoints_size = np.array(local_midpoints.size)
-    local_midpoints_sizes = np.empty(MPI.COMM_WORLD.size, dtype=int)
-    MPI.COMM_WORLD.Allgatherv(local_midpoints_size, local_midpoints_sizes)
-    midpoints = np.empty((num_cells, m.ufl_cell().geometric_dimension()), dtype=local_midpoints.dtype)
-    MPI.COMM_WORLD.Allgatherv(local_midpoints, (midpoints, local_midpoints_sizes))
-    assert len(np.unique(midpoints, axis=0)) == len(midpoints)
-    return midpoints, local_midpoints
+    if m.comm.size == 1:
+        # Every cell is local so there is nothing to gather
+        midpoints = local_midpoints.reshape((-1, gdim)).copy()
+    else:
+        # The collectives use the mesh's own (duplicated) communicator
+        # rather than COMM_WORLD so can't interfere with any others.
+        # Every rank contributes exactly one size so an equal-count
+        # Allgather suffices here. The total number of cells follows from
+        # the gathered sizes so no separate reduction is needed.
+        local_midpoints_size = np.array([local_midpoints.size], dtype=int)
+        local_midpoints_sizes = np.empty(m.comm.size, dtype=int)
+        m.comm.Allgather(local_midpoints_size, local_midpoints_sizes)
+        local_midpoints_displs = np.concatenate(([0], np.cumsum(local_midpoints_sizes)[:-1]))
+        num_cells = local_midpoints_sizes.sum() // gdim
+        midpoints = np.empty((num_cells, gdim), dtype=local_midpoints.dtype)
+        # Put the local midpoints straight into their place in the global
+        # array and gather in place so no separate send buffer is needed.
+        # The MPI datatype is given explicitly to match the (contiguous)
+        # buffer since it is complex in complex mode.
+        start = local_midpoints_displs[m.comm.rank]
+        midpoints.reshape(-1)[start:start + local_midpoints.size] = local_midpoints.reshape(-1)
+        midpoints_mpi_type = MPI._typedict[midpoints.dtype.char]
+        m.comm.Allgatherv(MPI.IN_PLACE, (midpoints, (local_midpoints_sizes, local_midpoints_displs), midpoints_mpi_type))
+    # Check the midpoints are distinct. Hashing the bytes of each row
+    # needs no sorted copy of the array.
+    assert len({row.tobytes() for row in midpoints}) == len(midpoints)
+    return m.__dict__.setdefault("_cell_midpoints", (midpoints, local_midpoints, f))
+
+
+def sorted_rows(a):
+    """Return the rows of the 2D array `a` in lexicographic order.
+
+    Unlike `np.sort(a)`, which sorts within each row, this keeps every
+    row (i.e. every point) intact so arrays of points can be compared
+    irrespective of their ordering."""
+    a = np.asarray(a)
+    return a[np.lexsort(a.T[::-1])]
+
+
+@contextmanager
+def swarm_field(swarm, name):
+    """Context manager giving the array of field `name` of DMSwarm
+    `swarm`. The array is not a copy so is only valid inside the
+    context, on leaving which the field is restored."""
+    field = swarm.getField(name)
+    try:
+        yield field
+    finally:
+        swarm.restoreField(name)
 
 
 @pytest.fixture(params=[pytest.param("interval", marks=pytest.mark.xfail(reason="swarm not implemented in 1d")),
@@ -42,7 +91,8 @@ def cell_midpoints(m):
                         "cube",
                         "tetrahedron",
                         pytest.param("immersedsphere", marks=pytest.mark.skip(reason="immersed parent meshes not supported and will segfault PETSc when creating the DMSwarm")),
-                        pytest.param("periodicrectangle", marks=pytest.mark.skip(reason="periodic meshes do not work properly with swarm creation"))])
+                        pytest.param("periodicrectangle", marks=pytest.mark.skip(reason="periodic meshes do not work properly with swarm creation"))],
+                scope="module")
 def parentmesh(request):
     if request.param == "interval":
         return UnitIntervalMesh(1)
@@ -69,56 +119,59 @@ def test_pic_swarm_in_plex(parentmesh):
     # Setup
 
     parentmesh.init()
-    inputpointcoords, inputlocalpointcoords = cell_midpoints(parentmesh)
+    gdim = parentmesh.geometric_dimension()
+    inputpointcoords, inputlocalpointcoords, _ = cell_midpoints(parentmesh)
     plex = parentmesh.topology.topology_dm
     from firedrake.petsc import PETSc
     fields = [("fieldA", 1, PETSc.IntType), ("fieldB", 2, PETSc.ScalarType)]
     swarm = mesh._pic_swarm_in_plex(plex, inputpointcoords, fields=fields)
-    # Get point coords on current MPI rank
-    localpointcoords = np.copy(swarm.getField("DMSwarmPIC_coor"))
-    swarm.restoreField("DMSwarmPIC_coor")
-    if len(inputpointcoords.shape) > 1:
-        localpointcoords = np.reshape(localpointcoords, (-1, inputpointcoords.shape[1]))
-    # Turn this into a number of points locally and MPI globally before
-    # doing any tests to avoid making tests hang should a failure occur
-    # on not all MPI ranks
-    nptslocal = len(localpointcoords)
-    nptsglobal = MPI.COMM_WORLD.allreduce(nptslocal, op=MPI.SUM)
-    # Get parent PETSc cell indices on current MPI rank
-    localparentcellindices = np.copy(swarm.getField("DMSwarm_cellid"))
-    swarm.restoreField("DMSwarm_cellid")
-
-    # Tests
-
-    # get custom fields on swarm - will fail if didn't get created
-    for name, size, dtype in fields:
-        f = swarm.getField(name)
-        assert len(f) == size*nptslocal
-        assert f.dtype == dtype
-        swarm.restoreField(name)
-    # Check comm sizes match
-    assert plex.comm.size == swarm.comm.size
-    # Check coordinate list and parent cell indices match
-    assert len(localpointcoords) == len(localparentcellindices)
-    # check local points are found in list of input points
-    for p in localpointcoords:
-        assert np.any(np.isclose(p, inputpointcoords))
-    # check local points are correct local points given mesh
-    # partitioning (but don't require ordering to be maintained)
-    assert np.allclose(np.sort(inputlocalpointcoords), np.sort(localpointcoords))
-    # Check methods for checking number of points on current MPI rank
-    assert len(localpointcoords) == swarm.getLocalSize()
-    # Check there are as many local points as there are local cells
-    # (excluding ghost cells in the halo)
-    assert len(localpointcoords) == parentmesh.cell_set.size
-    # Check total number of points on all MPI ranks is correct
-    # (excluding ghost cells in the halo)
-    assert nptsglobal == len(inputpointcoords)
-    assert nptsglobal == swarm.getSize()
-    # Check the parent cell indexes match those in the parent mesh
-    cell_indexes = parentmesh.cell_closure[:, -1]
-    for index in localparentcellindices:
-        assert np.any(index == cell_indexes)
+    # Get point coords and parent PETSc cell indices on current MPI rank.
+    # The swarm fields are read in place rather than copied so all the
+    # tests are done while they are checked out.
+    with swarm_field(swarm, "DMSwarmPIC_coor") as localpointcoords, swarm_field(swarm, "DMSwarm_cellid") as localparentcellindices:
+        localpointcoords = localpointcoords.reshape((-1, gdim))
+        # Turn this into a number of points locally and MPI globally before
+        # doing any tests to avoid making tests hang should a failure occur
+        # on not all MPI ranks
+        nptslocal = len(localpointcoords)
+        nptsglobal = np.array([nptslocal])
+        parentmesh.comm.Allreduce(MPI.IN_PLACE, nptsglobal, op=MPI.SUM)
+        nptsglobal = nptsglobal.item()
+
+        # Tests
+
+        # get custom fields on swarm - will fail if didn't get created
+        for name, size, dtype in fields:
+            with swarm_field(swarm, name) as f:
+                assert len(f) == size*nptslocal
+                assert f.dtype == dtype
+        # Check comm sizes match
+        assert plex.comm.size == swarm.comm.size
+        # Check coordinate list and parent cell indices match
+        assert len(localpointcoords) == len(localparentcellindices)
+        # check local points are found in list of input points. The swarm
+        # holds exact copies of the input points so rows can be compared
+        # exactly: viewing each row as a single opaque item lets np.isin do
+        # a sort based search rather than comparing every pair of points.
+        rowtype = np.dtype((np.void, localpointcoords.dtype.itemsize * gdim))
+        inputrows = np.ascontiguousarray(inputpointcoords.real, dtype=localpointcoords.dtype).view(rowtype)
+        localrows = np.ascontiguousarray(localpointcoords).view(rowtype)
+        assert np.all(np.isin(localrows, inputrows))
+        # check local points are correct local points given mesh
+        # partitioning (but don't require ordering to be maintained)
+        assert np.allclose(sorted_rows(inputlocalpointcoords), sorted_rows(localpointcoords))
+        # Check methods for checking number of points on current MPI rank
+        assert len(localpointcoords) == swarm.getLocalSize()
+        # Check there are as many local points as there are local cells
+        # (excluding ghost cells in the halo)
+        assert len(localpointcoords) == parentmesh.cell_set.size
+        # Check total number of points on all MPI ranks is correct
+        # (excluding ghost cells in the halo)
+        assert nptsglobal == len(inputpointcoords)
+        assert nptsglobal == swarm.getSize()
+        # Check the parent cell indexes match those in the parent mesh
+        cell_indexes = parentmesh.cell_closure[:, -1]
+        assert np.all(np.isin(localparentcellindices, cell_indexes))
 
 
 @pytest.mark.parallel
@@ -12,7 +12,8 @@ from mpi4py import MPI
                         "cube",
                         "tetrahedron",
                         pytest.param("immersedsphere", marks=pytest.mark.xfail(reason="immersed parent meshes not supported")),
-                        pytest.param("periodicrectangle", marks=pytest.mark.xfail(reason="meshes made from coordinate fields are not supported"))])
+                        pytest.param("periodicrectangle", marks=pytest.mark.xfail(reason="meshes made from coordinate fields are not supported"))],
+                scope="module")
 def parentmesh(request):
     if request.param == "interval":
         return UnitIntervalMesh(1)
@@ -30,7 +31,7 @@ def parentmesh(request):
         return PeriodicRectangleMesh(3, 3, 1, 1)
 
 
-@pytest.fixture(params=[0, 1, 100], ids=lambda x: f"{x}-coords")
+@pytest.fixture(params=[0, 1, 100], ids=lambda x: f"{x}-coords", scope="module")
 def vertexcoords(request, parentmesh):
     size = (request.param, parentmesh.geometric_dimension())
     return pseudo_random_coords(size)
@@ -40,20 +41,19 @@ def pseudo_random_coords(size):
     """
     Get an array of pseudo random coordinates with coordinate elements
     between -0.5 and 1.5. The random numbers are consistent for any
-    given `size` since `numpy.random.seed(0)` is called each time this
-    is used.
+    given `size` since a new generator seeded with 0 is used each time
+    this is used. The global numpy random state is left untouched.
     """
-    np.random.seed(0)
+    rng = np.random.default_rng(0)
     a, b = -0.5, 1.5
-    return (b - a) * np.random.random_sample(size=size) + a
+    return (b - a) * rng.random(size=size) + a
 
 
 # Function Space Generation Tests
 
-def functionspace_tests(vm):
+def functionspace_tests(vm, num_cells_mpi_global):
     # Prep
     num_cells = vm.num_cells()
-    num_cells_mpi_global = MPI.COMM_WORLD.allreduce(num_cells, op=MPI.SUM)
     # Can create DG0 function space
     V = FunctionSpace(vm, "DG", 0)
     # Can't create with degree > 0
@@ -87,11 +87,10 @@ def functionspace_tests(vm):
     assert np.isclose(assemble(f*dx), 2*num_cells_mpi_global)
 
 
-def vectorfunctionspace_tests(vm):
+def vectorfunctionspace_tests(vm, num_cells_mpi_global):
     # Prep
     gdim = vm.geometric_dimension()
     num_cells = vm.num_cells()
-    num_cells_mpi_global = MPI.COMM_WORLD.allreduce(num_cells, op=MPI.SUM)
     # Can create DG0 function space
     V = VectorFunctionSpace(vm, "DG", 0)
     # Can't create with degree > 0
@@ -126,8 +125,13 @@ def vectorfunctionspace_tests(vm):
 
 def test_functionspaces(parentmesh, vertexcoords):
     vm = VertexOnlyMesh(parentmesh, vertexcoords)
-    functionspace_tests(vm)
-    vectorfunctionspace_tests(vm)
+    # Both sets of tests need the MPI global number of cells so only
+    # reduce it once
+    num_cells_mpi_global = np.array([vm.num_cells()])
+    vm.comm.Allreduce(MPI.IN_PLACE, num_cells_mpi_global, op=MPI.SUM)
+    num_cells_mpi_global = num_cells_mpi_global.item()
+    functionspace_tests(vm, num_cells_mpi_global)
+    vectorfunctionspace_tests(vm, num_cells_mpi_global)
 
 
 @pytest.mark.parallel
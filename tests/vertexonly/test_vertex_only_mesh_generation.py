@@ -2,6 +2,7 @@ from firedrake import *
 import pytest
 import numpy as np
 from mpi4py import MPI
+from contextlib import contextmanager
 
 
 # Utility Functions
@@ -11,29 +12,77 @@ def cell_midpoints(m):
 
     :param m: The mesh to generate cell midpoints for.
 
-    :returns: A tuple of numpy arrays `(midpoints, local_midpoints)` where
+    :returns: A tuple `(midpoints, local_midpoints, f)` where
     `midpoints` are the midpoints for the entire mesh even if the mesh is
-    distributed and `local_midpoints` are the midpoints of only the
-    rank-local non-ghost cells."""
+    distributed, `local_midpoints` are the midpoints of only the
+    rank-local non-ghost cells and `f` is the DG0 vector
+    :class:`Function` of midpoints they were taken from. The result is
+    cached on `m` so repeated calls for the same mesh do no further
+    work."""
     if isinstance(m.topology, mesh.ExtrudedMeshTopology):
         raise NotImplementedError("Extruded meshes are not supported")
+    try:
+        return m.__dict__["_cell_midpoints"]
+    except KeyError:
+        pass
     m.init()
     V = VectorFunctionSpace(m, "DG", 0)
     f = Function(V).interpolate(SpatialCoordinate(m))
     # since mesh may be distributed, the number of cells on the MPI rank
     # may not be the same on all ranks (note we exclude ghost cells
-    # hence using num_cells_local = m.cell_set.size). Below local means
-    # MPI rank local.
-    num_cells_local = m.cell_set.size
-    num_cells = MPI.COMM_WORLD.allreduce(num_cells_local, op=MPI.SUM)
+    # hence using f.dat.data_ro rather than f.dat.data_ro_with_halos).
+    # Below local means MPI rank local.
+    gdim = m.geometric_dimension()
     local_midpoints = f.dat.data_ro
-    local_midpoints_size = np.array(local_midpoints.size)
-    local_midpoints_sizes = np.empty(MPI.COMM_WORLD.size, dtype=int)
-    MPI.COMM_WORLD.Allgatherv(local_midpoints_size, local_midpoints_sizes)
-    midpoints = np.empty((num_cells, m.ufl_cell().geometric_dimension()), dtype=local_midpoints.dtype)
-    MPI.COMM_WORLD.Allgatherv(local_midpoints, (midpoints, local_midpoints_sizes))
-    assert len(np.unique(midpoints, axis=0)) == len(midpoints)
-    return midpoints, local_midpoints
+    if m.comm.size == 1:
+        # Every cell is local so there is nothing to gather
+        midpoints = local_midpoints.reshape((-1, gdim)).copy()
+    else:
+        # The collectives use the mesh's own (duplicated) communicator
+        # rather than COMM_WORLD so can't interfere with any others.
+        # Every rank contributes exactly one size so an equal-count
+        # Allgather suffices here. The total number of cells follows from
+        # the gathered sizes so no separate reduction is needed.
+        local_midpoints_size = np.array([local_midpoints.size], dtype=int)
+        local_midpoints_sizes = np.empty(m.comm.size, dtype=int)
+        m.comm.Allgather(local_midpoints_size, local_midpoints_sizes)
+        local_midpoints_displs = np.concatenate(([0], np.cumsum(local_midpoints_sizes)[:-1]))
+        num_cells = local_midpoints_sizes.sum() // gdim
+        midpoints = np.empty((num_cells, gdim), dtype=local_midpoints.dtype)
+        # Put the local midpoints straight into their place in the global
+        # array and gather in place so no separate send buffer is needed.
+        # The MPI datatype is given explicitly to match the (contiguous)
+        # buffer since it is complex in complex mode.
+        start = local_midpoints_displs[m.comm.rank]
+        midpoints.reshape(-1)[start:start + local_midpoints.size] = local_midpoints.reshape(-1)
+        midpoints_mpi_type = MPI._typedict[midpoints.dtype.char]
+        m.comm.Allgatherv(MPI.IN_PLACE, (midpoints, (local_midpoints_sizes, local_midpoints_displs), midpoints_mpi_type))
+    # Check the midpoints are distinct. Hashing the bytes of each row
+    # needs no sorted copy of the array.
+    assert len({row.tobytes() for row in midpoints}) == len(midpoints)
+    return m.__dict__.setdefault("_cell_midpoints", (midpoints, local_midpoints, f))
+
+
+def sorted_rows(a):
+    """Return the rows of the 2D array `a` in lexicographic order.
+
+    Unlike `np.sort(a)`, which sorts within each row, this keeps every
+    row (i.e. every point) intact so arrays of points can be compared
+    irrespective of their ordering."""
+    a = np.asarray(a)
+    return a[np.lexsort(a.T[::-1])]
+
+
+@contextmanager
+def swarm_field(swarm, name):
+    """Context manager giving the array of field `name` of DMSwarm
+    `swarm`. The array is not a copy so is only valid inside the
+    context, on leaving which the field is restored."""
+    field = swarm.getField(name)
+    try:
+        yield field
+    finally:
+        swarm.restoreField(name)
 
 
 @pytest.fixture(params=[pytest.param("interval", marks=pytest.mark.xfail(reason="swarm not implemented in 1d")),
@@ -42,7 +91,8 @@ def cell_midpoints(m):
                         "cube",
                         "tetrahedron",
                         pytest.param("immersedsphere", marks=pytest.mark.xfail(reason="immersed parent meshes not supported")),
-                        pytest.param("periodicrectangle", marks=pytest.mark.xfail(reason="meshes made from coordinate fields are not supported"))])
+                        pytest.param("periodicrectangle", marks=pytest.mark.xfail(reason="meshes made from coordinate fields are not supported"))],
+                scope="module")
 def parentmesh(request):
     if request.param == "interval":
         return UnitIntervalMesh(1)
@@ -60,7 +110,7 @@ def parentmesh(request):
         return PeriodicRectangleMesh(3, 3, 1, 1)
 
 
-@pytest.fixture(params=[0, 1, 100], ids=lambda x: f"{x}-coords")
+@pytest.fixture(params=[0, 1, 100], ids=lambda x: f"{x}-coords", scope="module")
 def vertexcoords(request, parentmesh):
     size = (request.param, parentmesh.geometric_dimension())
     return pseudo_random_coords(size)
@@ -70,16 +120,52 @@ def pseudo_random_coords(size):
     """
     Get an array of pseudo random coordinates with coordinate elements
     between -0.5 and 1.5. The random numbers are consistent for any
-    given `size` since `numpy.random.seed(0)` is called each time this
-    is used.
+    given `size` since a new generator seeded with 0 is used each time
+    this is used. The global numpy random state is left untouched.
     """
-    np.random.seed(0)
+    rng = np.random.default_rng(0)
     a, b = -0.5, 1.5
-    return (b - a) * np.random.random_sample(size=size) + a
+    return (b - a) * rng.random(size=size) + a
 
 
 # Mesh Generation Tests
 
+def owned_point_indices(m, coords):
+    """
+    Get the indices of the points in `coords` which are in cells of
+    mesh `m` owned by this MPI rank (i.e. not in the halo). `coords`
+    should be the same for all MPI ranks to avoid hanging.
+    """
+    if len(coords) == 0:
+        # Nothing to locate - since coords is the same on all ranks
+        # every rank returns here together.
+        return []
+    gdim = m.geometric_dimension()
+    # The first locate_cell call is collective (it builds the spatial
+    # index) so make it on every rank with a point which is never in the
+    # mesh.
+    assert m.locate_cell(np.full(gdim, np.inf)) is None
+    # Only points in the bounding box of the cells owned by this rank
+    # can be in those cells so filter with that before calling
+    # locate_cell. Each point is then only located on the ranks whose
+    # part of the mesh it might be in rather than on every rank.
+    _, owned, _ = m.cell_set.sizes
+    owned_nodes = m.coordinates.function_space().cell_node_list[:owned]
+    owned_coords = m.coordinates.dat.data_ro_with_halos.real.reshape(-1, gdim)[owned_nodes.ravel()]
+    if len(owned_coords) == 0:
+        return []
+    tol = 1e-8
+    lower = owned_coords.min(axis=0) - tol
+    upper = owned_coords.max(axis=0) + tol
+    candidates = np.flatnonzero(np.all((lower <= coords) & (coords <= upper), axis=1))
+    indices = []
+    for i in candidates:
+        cell_num = m.locate_cell(coords[i])
+        if cell_num is not None and cell_num < owned:
+            indices.append(i)
+    return indices
+
+
 def verify_vertexonly_mesh(m, vm, inputvertexcoords):
     """
     Check that VertexOnlyMesh `vm` immersed in parent mesh `m` with
@@ -94,14 +180,9 @@ def verify_vertexonly_mesh(m, vm, inputvertexcoords):
     # Can initialise
     vm.init()
     # Find in-bounds and non-halo-region input coordinates
-    in_bounds = []
-    _, owned, _ = m.cell_set.sizes
-    for i in range(len(inputvertexcoords)):
-        cell_num = m.locate_cell(inputvertexcoords[i])
-        if cell_num is not None and cell_num < owned:
-            in_bounds.append(i)
+    in_bounds = owned_point_indices(m, inputvertexcoords)
     # Correct coordinates (though not guaranteed to be in same order)
-    np.allclose(np.sort(vm.coordinates.dat.data_ro), np.sort(inputvertexcoords[in_bounds]))
+    assert np.allclose(sorted_rows(vm.coordinates.dat.data_ro), sorted_rows(inputvertexcoords[in_bounds]))
     # Correct parent topology
     assert vm._parent_mesh is m
     assert vm.topology._parent_mesh is m.topology
@@ -118,14 +199,13 @@ def verify_vertexonly_mesh(m, vm, inputvertexcoords):
     assert vm.num_faces() == vm.num_entities(2) == 0
     assert vm.num_edges() == vm.num_entities(1) == 0
     assert vm.num_vertices() == vm.num_entities(0) == vm.num_cells()
-    # Correct parent cell numbers
-    stored_vertex_coords = np.copy(vm.topology_dm.getField("DMSwarmPIC_coor")).reshape((vm.num_cells(), gdim))
-    vm.topology_dm.restoreField("DMSwarmPIC_coor")
-    stored_parent_cell_nums = np.copy(vm.topology_dm.getField("parentcellnum"))
-    vm.topology_dm.restoreField("parentcellnum")
-    assert len(stored_vertex_coords) == len(stored_parent_cell_nums)
-    for i in range(len(stored_vertex_coords)):
-        assert m.locate_cell(stored_vertex_coords[i]) == stored_parent_cell_nums[i]
+    # Correct parent cell numbers (the swarm fields are read in place
+    # rather than copied)
+    with swarm_field(vm.topology_dm, "DMSwarmPIC_coor") as stored_vertex_coords, swarm_field(vm.topology_dm, "parentcellnum") as stored_parent_cell_nums:
+        stored_vertex_coords = stored_vertex_coords.reshape((vm.num_cells(), gdim))
+        assert len(stored_vertex_coords) == len(stored_parent_cell_nums)
+        for i in range(len(stored_vertex_coords)):
+            assert m.locate_cell(stored_vertex_coords[i]) == stored_parent_cell_nums[i]
 
 
 def test_generate_cell_midpoints(parentmesh):
@@ -133,22 +213,18 @@ def test_generate_cell_midpoints(parentmesh):
     Generate cell midpoints for mesh parentmesh and check they lie in
     the correct cells
     """
-    inputcoords, inputcoordslocal = cell_midpoints(parentmesh)
+    inputcoords, inputcoordslocal, f = cell_midpoints(parentmesh)
     vm = VertexOnlyMesh(parentmesh, inputcoords)
     # Midpoints located in correct cells of parent mesh
-    V = VectorFunctionSpace(parentmesh, "DG", 0)
-    f = Function(V).interpolate(SpatialCoordinate(parentmesh))
-    # Check size of biggest len(vm.coordinates.dat.data_ro) so
-    # locate_cell can be called on every processor
-    max_len = MPI.COMM_WORLD.allreduce(len(vm.coordinates.dat.data_ro), op=MPI.MAX)
+    # The first locate_cell call is collective (it builds the spatial
+    # index) so make it on every processor with a point which is never
+    # in the mesh. Each processor can then locate just its own points.
     out_of_mesh_point = np.full((1, parentmesh.geometric_dimension()), np.inf)
-    for i in range(max_len):
-        if i < len(vm.coordinates.dat.data_ro):
-            cell_num = parentmesh.locate_cell(vm.coordinates.dat.data_ro[i])
-        else:
-            cell_num = parentmesh.locate_cell(out_of_mesh_point)  # should return None
+    assert parentmesh.locate_cell(out_of_mesh_point) is None
+    for coord in vm.coordinates.dat.data_ro:
+        cell_num = parentmesh.locate_cell(coord)
         if cell_num is not None:
-            assert all(f.dat.data_ro[cell_num] == vm.coordinates.dat.data_ro[i])
+            assert all(f.dat.data_ro[cell_num] == coord)
 
 
 @pytest.mark.parallel
@@ -168,6 +244,6 @@ def test_generate_random_parallel(parentmesh, vertexcoords):
 
 @pytest.mark.xfail(raises=NotImplementedError)
 def test_extrude(parentmesh):
-    inputcoords, inputcoordslocal = cell_midpoints(parentmesh)
+    inputcoords, inputcoordslocal, _ = cell_midpoints(parentmesh)
     vm = VertexOnlyMesh(parentmesh, inputcoords)
     ExtrudedMesh(vm, 1)